@@ -1,6 +1,10 @@
 import os
+import re
+import Queue
 import logging
+import threading
 import subprocess
+from contextlib import closing
 from collections import namedtuple
 import xml.etree.ElementTree as ElementTree
 
@@ -53,6 +57,42 @@ class Priority(object):
     values = range(MIN, MAX + 1)
 
 
+def _escape_markdown(text):
+    """
+    Escape characters that Markdown would otherwise interpret.
+    """
+    return re.sub(r'([\\`*_{}\[\]()#+!])', r'\\\1', text)
+
+
+# Sentinel marking the end of the items flowing through the result pipeline
+_END_OF_PIPELINE = object()
+
+
+def _put(queue, item, stop):
+    """
+    Put an item in a bounded queue, giving up if the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            pass
+
+
+def _get(queue, stop):
+    """
+    Get an item from a queue, or the end of pipeline sentinel if the pipeline
+    is stopped.
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return _END_OF_PIPELINE
+
+
 class PMDTool(Tool):
     name = 'PMD Source Code Analyzer'
     version = '0.2.1'
@@ -109,10 +149,29 @@ class PMDTool(Tool):
                 'required': False,
             },
         },
+        {
+            'name': 'violation_budget',
+            'field_type': 'django.forms.IntegerField',
+            'default': 0,
+            'field_options': {
+                'label': 'Violation budget',
+                'help_text': 'Number of violations with a priority of '
+                             '"Maximum priority for open issues" or higher '
+                             'after which PMD stops analyzing the remaining '
+                             'files of a review. All the violations found in '
+                             'files analyzed so far are still reported. Use '
+                             '0 for no limit.',
+                'min_value': 0,
+                'required': False,
+            },
+        },
     ]
 
     supported_file_types = ('.java', '.js', '.xml', '.xsl')
 
+    # Maximum number of files waiting between two stages of the pipeline
+    pipeline_queue_size = 4
+
     def check_dependencies(self):
         # We need java installed to run PMD
         return is_exe_in_path('java')
@@ -122,6 +181,8 @@ class PMDTool(Tool):
         self.max_priority_for_issue = int(settings['max_priority_for_issue'])
         logging.debug("Will open issues for violations of priority %s or more"
                       % self.max_priority_for_issue)
+        self.violation_budget = int(settings['violation_budget'] or 0)
+        self.num_high_priority_violations = 0
         self.rulesets = set(settings['rulesets'].split(','))
         self.pmd_script_path = os.path.join(
             settings['pmd_install_path'], 'bin/run.sh')
@@ -141,13 +202,148 @@ class PMDTool(Tool):
             self.ignored_files.update(f.dest_file for f in files)
             logging.error(e.message)
             return
-        super(PMDTool, self).handle_files(files)
+        files = list(files)
+        over_budget = False
+        # Make sure the pipeline is stopped whichever way we leave the loop
+        with closing(self.iter_results(files)) as results:
+            for reviewed_file, pmd_result in results:
+                self.count_high_priority_violations(pmd_result)
+                self.post_comments(
+                    pmd_result, reviewed_file, use_markdown=self.use_markdown)
+                self.processed_files.add(reviewed_file.dest_file)
+                if self.is_violation_budget_exceeded():
+                    # Over budget: stop the pipeline, dropping the results
+                    # that have not been reported yet.
+                    over_budget = True
+                    break
+        if not over_budget:
+            return
+        remaining_files = [f for f in files
+                           if f.dest_file not in self.processed_files and
+                           f.dest_file not in self.ignored_files]
+        self.ignored_files.update(f.dest_file for f in remaining_files)
+        skipped_files = [f for f in remaining_files if self.is_supported(f)]
+        if skipped_files:
+            logging.info("Violation budget of %s exceeded, skipped %s files"
+                         % (self.violation_budget, len(skipped_files)))
+            self.post_budget_summary(reviewed_file, skipped_files)
+
+    def iter_results(self, files):
+        """
+        Analyze files with PMD and yield (reviewed_file, Result) pairs as
+        soon as each file has been analyzed.
+
+        Running PMD and parsing its results are done in separate threads,
+        connected by bounded queues, so that results can be consumed while
+        PMD is still analyzing the remaining files. Files that cannot be
+        analyzed are added to ignored_files. Unexpected errors in any stage
+        are re-raised.
+
+        Closing the generator stops the pipeline: PMD is not run on any
+        other file, a PMD run already in progress is allowed to finish, and
+        results that have not been consumed yet are dropped.
+        """
+        stop = threading.Event()
+        errors = []
+        analyzed = Queue.Queue(maxsize=self.pipeline_queue_size)
+        parsed = Queue.Queue(maxsize=self.pipeline_queue_size)
+        # Each file entering the pipeline takes a slot, which is given back
+        # once its result has been consumed.
+        slots = Queue.Queue()
+        for _ in range(self.pipeline_queue_size):
+            slots.put(True)
+
+        def analyze():
+            try:
+                for reviewed_file in files:
+                    if _get(slots, stop) is _END_OF_PIPELINE:
+                        break
+                    item = (reviewed_file, self.analyze_file(reviewed_file))
+                    _put(analyzed, item, stop)
+            except Exception as e:
+                logging.exception("Unexpected error while running PMD")
+                errors.append(e)
+            finally:
+                _put(analyzed, _END_OF_PIPELINE, stop)
+
+        def parse():
+            try:
+                while True:
+                    item = _get(analyzed, stop)
+                    if item is _END_OF_PIPELINE:
+                        break
+                    reviewed_file, paths = item
+                    pmd_result = None
+                    if paths:
+                        pmd_result = self.parse_result(reviewed_file, *paths)
+                    _put(parsed, (reviewed_file, pmd_result), stop)
+            except Exception as e:
+                logging.exception("Unexpected error while parsing PMD results")
+                errors.append(e)
+            finally:
+                _put(parsed, _END_OF_PIPELINE, stop)
+
+        stages = [threading.Thread(target=analyze),
+                  threading.Thread(target=parse)]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        try:
+            while True:
+                item = _get(parsed, stop)
+                if item is _END_OF_PIPELINE:
+                    break
+                reviewed_file, pmd_result = item
+                if pmd_result is None:
+                    self.ignored_files.add(reviewed_file.dest_file)
+                else:
+                    yield reviewed_file, pmd_result
+                slots.put(True)
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+
+    def is_supported(self, reviewed_file):
+        return any(reviewed_file.dest_file.lower().endswith(extension)
+                   for extension in self.supported_file_types)
+
+    def is_violation_budget_exceeded(self):
+        return (self.violation_budget > 0 and
+                self.num_high_priority_violations >= self.violation_budget)
+
+    def count_high_priority_violations(self, pmd_result):
+        self.num_high_priority_violations += len(
+            [v for v in pmd_result.violations
+             if v.priority <= self.max_priority_for_issue])
 
     def handle_file(self, reviewed_file):
-        if not any(reviewed_file.dest_file.lower().endswith(extension)
-                   for extension in self.supported_file_types):
-            # Ignore the file.
+        # handle_files() goes through iter_results(), which is also where
+        # the violation budget is enforced. This only remains to implement
+        # the Tool interface for callers handling a single file.
+        paths = self.analyze_file(reviewed_file)
+        if not paths:
+            return False
+        pmd_result = self.parse_result(reviewed_file, *paths)
+        if pmd_result is None:
             return False
+        self.post_comments(
+            pmd_result, reviewed_file, use_markdown=self.use_markdown)
+
+        return True
+
+    def analyze_file(self, reviewed_file):
+        """
+        Run PMD on a reviewed file.
+
+        Returns a (source file path, PMD result file path) tuple, or None if
+        the file could not be analyzed.
+        """
+        if not self.is_supported(reviewed_file):
+            # Ignore the file.
+            return None
 
         logging.debug('PMD will start analyzing file %s' %
                       reviewed_file.dest_file)
@@ -158,16 +354,25 @@ class PMDTool(Tool):
         except APIError:
             logging.warn("Failed to get patched file for %s - ignoring file" %
                          reviewed_file.source_file)
-            return False
+            return None
         if not temp_source_file_path:
-            return False
+            return None
 
         try:
             pmd_result_file_path = self.run_pmd(
                 temp_source_file_path, self.rulesets)
         except PMDError as e:
             logging.error(e)
-            return False
+            return None
+        return temp_source_file_path, pmd_result_file_path
+
+    def parse_result(self, reviewed_file, temp_source_file_path,
+                     pmd_result_file_path):
+        """
+        Parse the PMD result file for a reviewed file.
+
+        Returns a Result, or None if the result file is invalid.
+        """
         try:
             pmd_result = Result.from_xml(pmd_result_file_path,
                                          temp_source_file_path)
@@ -176,11 +381,8 @@ class PMDTool(Tool):
                          (len(pmd_result.violations), reviewed_file.dest_file))
         except ValueError as e:
             logging.error(e.message)
-            return False
-        self.post_comments(
-            pmd_result, reviewed_file, use_markdown=self.use_markdown)
-
-        return True
+            return None
+        return pmd_result
 
     def run_pmd(self, source_file_path, rulesets):
         pmd_result_file_path = make_tempfile(extension='.xml')
@@ -215,6 +417,27 @@ class PMDTool(Tool):
             reviewed_file.comment(
                 comment, v.first_line, v.num_lines, issue=open_issue)
 
+    def post_budget_summary(self, reviewed_file, skipped_files):
+        """
+        Post a comment listing the files that were not reviewed because the
+        violation budget was exceeded.
+
+        Comments are the only part of the review this tool publishes
+        itself, so the summary is posted as a comment on the file whose
+        violations exceeded the budget, which was reviewed.
+        """
+        summary = ("PMD analysis was cut short after finding %s violations "
+                   "of priority %s or higher (budget: %s). The following "
+                   "files were not reviewed:\n\n" %
+                   (self.num_high_priority_violations,
+                    self.max_priority_for_issue,
+                    self.violation_budget))
+        file_names = [f.dest_file for f in skipped_files]
+        if self.use_markdown:
+            file_names = [_escape_markdown(name) for name in file_names]
+        summary += '\n'.join(" * %s" % name for name in file_names)
+        reviewed_file.comment(summary, 1, issue=False)
+
 _BaseViolation = namedtuple(
     'Violation', 'rule priority text url first_line last_line')
 
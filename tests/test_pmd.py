@@ -1,7 +1,9 @@
 import os
+import sys
 import subprocess
 import shutil
 import tempfile
+import threading
 from collections import namedtuple
 from nose import SkipTest
 from nose.tools import *
@@ -130,6 +132,7 @@ class TestPMDTool(object):
             'pmd_install_path': pmd_install_path,
             'rulesets': 'java-comments',
             'max_priority_for_issue': 5,
+            'violation_budget': 0,
         }
         self.num_violations = 2
         self.pmd.settings = default_settings
@@ -137,6 +140,16 @@ class TestPMDTool(object):
         self.pmd.processed_files = set()
         self.pmd.ignored_files = set()
 
+    def count_run_pmd_calls(self):
+        run_pmd_calls = []
+        run_pmd = self.pmd.run_pmd
+
+        def counting_run_pmd(*args, **kwargs):
+            run_pmd_calls.append(args)
+            return run_pmd(*args, **kwargs)
+        self.pmd.run_pmd = counting_run_pmd
+        return run_pmd_calls
+
     def is_valid_ruleset_file(self, filepath):
         if not os.path.exists(filepath):
             return False
@@ -236,6 +249,142 @@ class TestPMDTool(object):
         assert self.pmd.processed_files == set()
         assert self.pmd.ignored_files == set([reviewed_file.dest_file])
 
+    def test_handle_files_violation_budget_exceeded(self):
+        self.pmd.settings['violation_budget'] = 1
+        first_file = FileMock(java_source_path, java_source_path)
+        skipped_file = FileMock(java_source_path, 'Skipped.java')
+        self.pmd.handle_files([first_file, skipped_file])
+        assert self.pmd.processed_files == set([first_file.dest_file])
+        assert self.pmd.ignored_files == set([skipped_file.dest_file])
+        # All the violations of the first file are reported, followed by
+        # the summary
+        assert len(first_file.comments) == self.num_violations + 1
+        summary = first_file.comments[-1]
+        assert skipped_file.dest_file in summary.text
+        assert not summary.issue
+        assert len(skipped_file.comments) == 0
+
+    def test_handle_files_violation_budget_stops_pmd_runs(self):
+        self.pmd.settings['violation_budget'] = 1
+        self.pmd.pipeline_queue_size = 4
+        run_pmd_calls = self.count_run_pmd_calls()
+        reviewed_files = [FileMock(java_source_path, 'File%s.java' % i)
+                          for i in range(10)]
+        self.pmd.handle_files(reviewed_files)
+        assert len(run_pmd_calls) <= self.pmd.pipeline_queue_size
+        assert self.pmd.processed_files == set([reviewed_files[0].dest_file])
+        assert self.pmd.ignored_files == set(f.dest_file
+                                             for f in reviewed_files[1:])
+        # Files analyzed while the budget was being exceeded are listed
+        # too, as their violations were not reported
+        summary = reviewed_files[0].comments[-1].text
+        assert all(f.dest_file in summary for f in reviewed_files[1:])
+        assert all(not f.comments for f in reviewed_files[1:])
+
+    def test_handle_files_violation_budget_ignores_unsupported_files(self):
+        self.pmd.settings['violation_budget'] = 1
+        reviewed_files = [FileMock(java_source_path, 'A.java'),
+                          FileMock(dest_file='README.md'),
+                          FileMock(java_source_path, 'B.java'),
+                          FileMock(dest_file='notes.txt')]
+        self.pmd.handle_files(reviewed_files)
+        assert self.pmd.processed_files == set(['A.java'])
+        assert self.pmd.ignored_files == set(
+            ['README.md', 'B.java', 'notes.txt'])
+        summary = reviewed_files[0].comments[-1].text
+        assert 'B.java' in summary
+        assert 'README.md' not in summary
+        assert 'notes.txt' not in summary
+
+    def test_handle_files_violation_budget_summary_markdown(self):
+        self.pmd.settings['violation_budget'] = 1
+        self.pmd.settings['markdown'] = True
+        reviewed_files = [FileMock(java_source_path, 'A.java'),
+                          FileMock(java_source_path, 'my_*file*.java')]
+        self.pmd.handle_files(reviewed_files)
+        summary = reviewed_files[0].comments[-1].text
+        assert_equals(summary.splitlines()[-1], ' * my\\_\\*file\\*.java')
+
+    def test_handle_files_pipeline_error(self):
+        run_pmd_calls = []
+        run_pmd = self.pmd.run_pmd
+
+        def failing_run_pmd(source_file_path, rulesets):
+            run_pmd_calls.append(source_file_path)
+            if len(run_pmd_calls) > 1:
+                raise OSError("PMD could not be started")
+            return run_pmd(source_file_path, rulesets)
+        self.pmd.run_pmd = failing_run_pmd
+        reviewed_files = [FileMock(java_source_path, 'A.java'),
+                          FileMock(java_source_path, 'B.java'),
+                          FileMock(java_source_path, 'C.java')]
+        assert_raises(OSError, self.pmd.handle_files, reviewed_files)
+        assert all(not f.comments for f in reviewed_files[1:])
+
+    def test_handle_files_post_comments_error(self):
+        self.pmd.pipeline_queue_size = 2
+        run_pmd_calls = self.count_run_pmd_calls()
+
+        def failing_post_comments(*args, **kwargs):
+            raise RuntimeError("Could not post comments")
+        self.pmd.post_comments = failing_post_comments
+        num_threads = threading.active_count()
+        reviewed_files = [FileMock(java_source_path, 'File%s.java' % i)
+                          for i in range(10)]
+        try:
+            self.pmd.handle_files(reviewed_files)
+        except RuntimeError:
+            # Keep the traceback alive, so that the pipeline can't be
+            # stopped by garbage collection
+            traceback = sys.exc_info()[2]
+        assert traceback is not None
+        assert len(run_pmd_calls) <= self.pmd.pipeline_queue_size
+        assert_equals(threading.active_count(), num_threads)
+
+    def test_handle_files_violation_budget_disabled(self):
+        reviewed_files = [FileMock(java_source_path, java_source_path),
+                          FileMock(java_source_path, 'Other.java')]
+        self.pmd.handle_files(reviewed_files)
+        assert self.pmd.processed_files == set(f.dest_file
+                                               for f in reviewed_files)
+        assert self.pmd.ignored_files == set()
+        assert all(len(f.comments) == self.num_violations
+                   for f in reviewed_files)
+
+    def test_iter_results(self):
+        reviewed_files = [FileMock(java_source_path, java_source_path),
+                          FileMock(java_source_path, 'Other.java')]
+        results = list(self.pmd.iter_results(reviewed_files))
+        assert_equals([f for f, _ in results], reviewed_files)
+        assert all(len(r.violations) == self.num_violations
+                   for _, r in results)
+        assert self.pmd.ignored_files == set()
+
+    def test_iter_results_ignores_invalid_files(self):
+        reviewed_files = [FileMock(dest_file='test.php'),
+                          FileMock(dest_file=invalid_source_path),
+                          FileMock(java_source_path, java_source_path)]
+        results = list(self.pmd.iter_results(reviewed_files))
+        assert_equals([f for f, _ in results], reviewed_files[-1:])
+        assert self.pmd.ignored_files == set(
+            f.dest_file for f in reviewed_files[:-1])
+
+    def test_iter_results_close(self):
+        self.pmd.pipeline_queue_size = 2
+        run_pmd_calls = self.count_run_pmd_calls()
+        num_threads = threading.active_count()
+        reviewed_files = [FileMock(java_source_path, 'File%s.java' % i)
+                          for i in range(10)]
+        results = self.pmd.iter_results(reviewed_files)
+        reviewed_file, _ = next(results)
+        assert reviewed_file is reviewed_files[0]
+        # The first result is available before PMD has run on every file
+        assert 1 <= len(run_pmd_calls) <= self.pmd.pipeline_queue_size
+        results.close()
+        assert_raises(StopIteration, next, results)
+        assert len(run_pmd_calls) <= self.pmd.pipeline_queue_size
+        assert_equals(threading.active_count(), num_threads)
+
     def test_post_comments(self):
         result = mock_result()
         reviewed_file = FileMock(java_source_path)